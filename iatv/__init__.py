@@ -1,4 +1,8 @@
 from .iatv import (
-    Show, search_items, download_all_transcripts, summarize,
-    summarize_standard_dir, DOWNLOAD_BASE_URL
+    Show, search_items, download_all_transcripts, download_transcript,
+    run_worker, summarize, summarize_standard_dir, TranscriptUnavailable,
+    DOWNLOAD_BASE_URL
 )
+from .workqueue import WorkQueue
+from .compact import CompactShow, TextStore, iter_show_batches
+from .profiling import ShowProfile
@@ -0,0 +1,375 @@
+'''
+compact.py: Memory-lean, read-only representations of downloaded shows for
+analysing thousands of them at once.
+
+A ``Show`` keeps its metadata, the full SRT string, the full transcript and
+a per-instance ``__dict__``, and building it creates a pycaption ``Caption``
+per line. ``CompactShow`` instead keeps caption timings in typed arrays and
+caption text either as interned strings or in a disk-backed ``TextStore``.
+Strings are interned through a plain dict, passed around as ``strings``,
+rather than ``intern``, which on Python 2 does not accept unicode.
+
+Example, with shows downloaded by ``download_all_transcripts``:
+
+>>> from iatv import iter_show_batches
+>>> for batch in iter_show_batches('July2016', max_memory=200 * 2**20):
+...     for show in batch:
+...         print(show.identifier, len(show.captions))
+'''
+import glob
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+
+from array import array
+
+_STRING_TYPES = (str, type(u''))
+
+
+def _intern(text, strings):
+    '''
+    Returns:
+        (str) the copy of ``text`` already in the ``strings`` dict, adding
+        ``text`` to it if there is none
+    '''
+    return strings.setdefault(text, text)
+
+
+SRT_BLOCK_PATT = re.compile(
+    r'(\d+):(\d{2}):(\d{2})[,.](\d{3})\s*-->\s*'
+    r'(\d+):(\d{2}):(\d{2})[,.](\d{3})[^\n]*\n(.*?)(?:\n\s*\n|\Z)',
+    re.DOTALL
+)
+
+
+def parse_srt(srt):
+    '''
+    Parse SRT captions without building pycaption objects.
+
+    Arguments:
+        srt (str): SRT-formatted captions
+
+    Returns:
+        (generator) of (start_ms, end_ms, text) tuples, with the lines of
+        each caption's text joined by spaces
+    '''
+    for m in SRT_BLOCK_PATT.finditer(srt.replace('\r\n', '\n')):
+        h0, m0, s0, ms0, h1, m1, s1, ms1 = (int(g) for g in m.groups()[:8])
+
+        start = ((h0 * 60 + m0) * 60 + s0) * 1000 + ms0
+        end = ((h1 * 60 + m1) * 60 + s1) * 1000 + ms1
+        text = ' '.join(line.strip() for line in m.group(9).split('\n')
+                        if line.strip())
+
+        yield start, end, text
+
+
+class TextStore(object):
+    '''
+    Append-only UTF-8 text file holding caption text out of memory. Each
+    string added is addressed by the (offset, length) returned from ``add``.
+
+    Arguments:
+        path (str): file to use; a temporary file, removed on ``close``,
+            if None
+    '''
+    __slots__ = ('path', '_handle', '_owns_path', '_end')
+
+    def __init__(self, path=None):
+
+        self._owns_path = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='iatv-text-', suffix='.txt')
+            os.close(fd)
+
+        self.path = path
+        self._handle = io.open(path, 'a+b')
+        self._handle.seek(0, os.SEEK_END)
+        self._end = self._handle.tell()
+
+    def add(self, text):
+        '''
+        Returns:
+            (tuple(int, int)) offset and length in bytes of the stored text
+        '''
+        data = text.encode('utf-8')
+        offset = self._end
+
+        self._handle.seek(0, os.SEEK_END)
+        self._handle.write(data)
+        self._end += len(data)
+
+        return offset, len(data)
+
+    def get(self, offset, length):
+        self._handle.flush()
+        self._handle.seek(offset)
+        return self._handle.read(length).decode('utf-8')
+
+    def close(self):
+        self._handle.close()
+        if self._owns_path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CompactCaptions(object):
+    '''
+    Sequence of captions with start and end times, in milliseconds, held in
+    typed arrays. Indexing returns (start_ms, end_ms, text) tuples.
+
+    Text is held as interned strings until ``spill`` moves it to a
+    ``TextStore``, after which only byte offsets and lengths stay in memory.
+
+    Arguments:
+        captions (iterable): (start_ms, end_ms, text) tuples
+        strings (dict): intern table to share with other captions; a new
+            one if None
+    '''
+    __slots__ = ('starts', 'ends', '_texts', '_store', '_offsets', '_lengths')
+
+    def __init__(self, captions=(), strings=None):
+
+        if strings is None:
+            strings = {}
+
+        self.starts = array('l')
+        self.ends = array('l')
+        self._texts = []
+        self._store = None
+        self._offsets = None
+        self._lengths = None
+
+        for start, end, text in captions:
+            self.starts.append(start)
+            self.ends.append(end)
+            self._texts.append(_intern(text, strings))
+
+    @classmethod
+    def from_srt(cls, srt, strings=None):
+        return cls(parse_srt(srt), strings=strings)
+
+    @property
+    def spilled(self):
+        return self._store is not None
+
+    def text(self, i):
+        if self._store is None:
+            return self._texts[i]
+        return self._store.get(int(self._offsets[i]), self._lengths[i])
+
+    def texts(self):
+        '''
+        Returns:
+            (generator) of every caption's text, in order
+        '''
+        for i in range(len(self)):
+            yield self.text(i)
+
+    def spill(self, store):
+        '''
+        Move caption text into ``store``, a ``TextStore``.
+        '''
+        if self._store is not None:
+            return
+
+        # 'd' holds integers exactly up to 2**53 and, unlike 'q', exists on
+        # Python 2
+        offsets = array('d')
+        lengths = array('l')
+        for text in self._texts:
+            offset, length = store.add(text)
+            offsets.append(offset)
+            lengths.append(length)
+
+        self._offsets = offsets
+        self._lengths = lengths
+        self._store = store
+        self._texts = None
+
+    def nbytes(self):
+        '''
+        Returns:
+            (int) approximate memory held by these captions, in bytes.
+            Interned strings shared with other captions are counted each
+            time, so this errs high.
+        '''
+        n = sys.getsizeof(self.starts) + sys.getsizeof(self.ends)
+
+        if self._store is None:
+            n += sys.getsizeof(self._texts)
+            n += sum(sys.getsizeof(t) for t in self._texts)
+        else:
+            n += sys.getsizeof(self._offsets) + sys.getsizeof(self._lengths)
+
+        return n
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.starts[i], self.ends[i], self.text(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _intern_metadata(metadata, strings):
+
+    if isinstance(metadata, dict):
+        return dict((_intern(k, strings), _intern_metadata(v, strings))
+                    for k, v in metadata.items())
+    elif isinstance(metadata, list):
+        return [_intern_metadata(v, strings) for v in metadata]
+    elif isinstance(metadata, _STRING_TYPES):
+        return _intern(metadata, strings)
+
+    return metadata
+
+
+class CompactShow(object):
+    '''
+    Read-only, memory-lean counterpart of ``Show`` for a show that has
+    already been downloaded. Metadata keys and values are interned so that
+    repeated strings, e.g. channel names, are stored once across shows
+    sharing ``strings``.
+    The transcript is rebuilt from the captions when asked for rather than
+    stored.
+
+    Arguments:
+        identifier (str): archive.org show identifier
+        captions (CompactCaptions): the show's captions
+        metadata (dict): show metadata as saved by ``download_all_transcripts``
+        strings (dict): intern table to share with other shows; a new one
+            if None
+    '''
+    __slots__ = ('identifier', 'title', 'metadata', 'captions')
+
+    def __init__(self, identifier, captions, metadata=None, strings=None):
+
+        if strings is None:
+            strings = {}
+
+        self.identifier = _intern(identifier, strings)
+        self.metadata = \
+            _intern_metadata(metadata, strings) if metadata else None
+        self.captions = captions
+
+        title = self.metadata.get('title') if self.metadata else None
+        if isinstance(title, list):
+            title = title[0] if title else None
+        self.title = title
+
+    @classmethod
+    def from_show(cls, show, strings=None):
+        '''
+        Build from a ``Show`` whose transcript has been fetched.
+        '''
+        if strings is None:
+            strings = {}
+
+        return cls(show.identifier,
+                   CompactCaptions.from_srt(show.srt, strings=strings),
+                   metadata=show.metadata, strings=strings)
+
+    @classmethod
+    def from_directory(cls, show_dir, strings=None):
+        '''
+        Build from a ``{base_directory}/{identifier}`` directory as written
+        by ``download_all_transcripts``.
+        '''
+        if strings is None:
+            strings = {}
+
+        identifier = os.path.basename(os.path.normpath(show_dir))
+
+        metadata = None
+        md_path = os.path.join(show_dir, 'metadata.json')
+        if os.path.exists(md_path):
+            with io.open(md_path, encoding='utf-8') as f:
+                metadata = json.load(f)
+
+        captions = CompactCaptions()
+        for srt_path in glob.glob(os.path.join(show_dir, '*.srt')):
+            with io.open(srt_path, encoding='utf-8') as f:
+                captions = CompactCaptions.from_srt(f.read(), strings=strings)
+            break
+
+        return cls(identifier, captions, metadata=metadata, strings=strings)
+
+    def get_transcript(self):
+        '''
+        Returns:
+            (list(str)) text split on speaker changes, marked by ">>" in the
+            captions, as in ``Show.get_transcript``
+        '''
+        text = ' '.join(self.captions.texts())
+        return [t.strip() for t in text.split('>>')]
+
+    def nbytes(self):
+        '''
+        Returns:
+            (int) approximate memory held by this show, in bytes
+        '''
+        n = self.captions.nbytes()
+        if self.metadata:
+            n += len(json.dumps(self.metadata))
+        return n
+
+    def __repr__(self):
+        return '<CompactShow>\n\tTitle: {}\n\tIdentifier: {}\n</CompactShow>'\
+            .format(self.title, self.identifier)
+
+
+def iter_show_batches(directory, max_memory=256 * 2**20, text_store=None):
+    '''
+    Load every show downloaded to ``directory`` by
+    ``download_all_transcripts``, yielding them as lists of ``CompactShow``
+    whose combined ``nbytes`` stays under ``max_memory``. Drop each batch
+    before asking for the next to keep memory bounded. A single show larger
+    than ``max_memory`` is yielded alone. Shows in a batch share one intern
+    table, which is dropped with the batch.
+
+    Arguments:
+        directory (str): base directory holding one directory per show
+        max_memory (int): memory ceiling per batch, in bytes
+        text_store (TextStore): if given, caption text is spilled here and
+            only timings count towards ``max_memory``
+
+    Returns:
+        (generator) of lists of CompactShow
+    '''
+    batch = []
+    batch_bytes = 0
+    strings = {}
+
+    for show_dir in sorted(glob.glob(os.path.join(directory, '*'))):
+
+        if not os.path.isdir(show_dir):
+            continue
+
+        show = CompactShow.from_directory(show_dir, strings=strings)
+        if text_store is not None:
+            show.captions.spill(text_store)
+
+        n = show.nbytes()
+        if batch and batch_bytes + n > max_memory:
+            yield batch
+            batch = []
+            batch_bytes = 0
+            strings = {}
+
+        batch.append(show)
+        batch_bytes += n
+
+    if batch:
+        yield batch
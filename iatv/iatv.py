@@ -1,11 +1,15 @@
 '''
 iatv.py: Tools for dealing with TV News from the Internet Archive, archive.org
 '''
+import codecs
 import glob
 import json
 import os
 import re
 import requests
+import shutil
+import tempfile
+import time
 import unicodedata
 import warnings
 
@@ -22,6 +26,9 @@ from sumy.summarizers.lsa import LsaSummarizer as Summarizer
 from sumy.nlp.stemmers import Stemmer
 from sumy.utils import get_stop_words
 
+from .profiling import ShowProfile, stage
+from .workqueue import Heartbeat, LeaseLost, default_worker_id
+
 IATV_BASE_URL = 'https://archive.org/details/tv'
 DOWNLOAD_BASE_URL = 'https://archive.org/download/'
 
@@ -178,7 +185,14 @@ def search_items(query, channel=None, time=None, rows=None, start=None):
             raise e2
 
 
-def download_all_transcripts(show_specs, base_directory=None, verbose=True):
+class TranscriptUnavailable(RuntimeError):
+    '''
+    Raised by ``download_transcript`` when a show's captions can't be fetched.
+    '''
+
+
+def download_all_transcripts(show_specs, base_directory=None, verbose=True,
+                             throttle=None, profile=False):
     '''
     Download all transcripts for shows corresponding to their
     specification in each element of show_specs. Each show_spec should
@@ -190,43 +204,228 @@ def download_all_transcripts(show_specs, base_directory=None, verbose=True):
     >>> shows = [item in items if 'commercial' not in item]
     >>> download_all_transcripts(shows, base_directory='July2016')
 
+    To share the work between several processes or hosts, use a
+    ``WorkQueue`` and ``run_worker`` instead.
 
     Arguments:
         show_specs (list(dict)): list of specifications returned by
             search_items function
+        base_directory (str): directory where downloads should be put;
+            shows whose captions can't be fetched are skipped with a warning
+        throttle (callable): called before every request to archive.org,
+            e.g. ``WorkQueue.throttle``
+        profile (bool): profile each download as in ``download_transcript``
+
+    Returns:
+        (ShowProfile) if profile is True, the profiles of every downloaded
+        show merged into one, whose summary is also logged; otherwise None
+    '''
+
+    if not base_directory:
+        base_directory = 'default-downloads'
+
+    corpus_profile = ShowProfile(base_directory) if profile else None
+
+    for spec in show_specs:
+        show_profile = ShowProfile(spec['identifier']) if profile else None
+
+        try:
+            downloaded = download_transcript(
+                spec, base_directory=base_directory, verbose=verbose,
+                throttle=throttle, profile=show_profile
+            )
+        except TranscriptUnavailable as e:
+            warnings.warn('Skipping {}: {}'.format(spec['identifier'], e))
+            continue
+
+        if downloaded and show_profile is not None:
+            corpus_profile.merge(show_profile)
+
+    if corpus_profile is not None:
+        corpus_profile.log()
+
+    return corpus_profile
+
+
+def download_transcript(spec, base_directory=None, verbose=True,
+                        throttle=None, profile=None):
+    '''
+    Download transcript, metadata, and SRT for a single show to
+    ``{base_directory}/{identifier}``, unless its transcript.txt already
+    exists. Files are written to a temporary directory that is renamed into
+    place once complete, so concurrent or crashed downloads never leave a
+    partially-written show directory behind.
+
+    Arguments:
+        spec (dict): specification returned by search_items function
         base_directory (str): directory where downloads should be put
+        throttle (callable): called before every request to archive.org
+        profile (ShowProfile or bool): if given, profile each stage of the
+            download, from fetching metadata to writing files, into it (or
+            into a new ShowProfile if True) and save the profile as
+            profile.folded (collapsed stacks for flame graphs) and
+            profile.txt (summary) alongside the transcript
+
+    Returns:
+        (bool) True if the show was downloaded, False if it already existed
+
+    Raises:
+        TranscriptUnavailable: if no captions could be fetched; nothing is
+            written for the show
     '''
 
     if not base_directory:
         base_directory = 'default-downloads'
 
-    if not os.path.isdir(base_directory):
+    try:
         os.makedirs(base_directory)
+    except OSError:
+        if not os.path.isdir(base_directory):
+            raise
 
-    for spec in show_specs:
+    iden = spec['identifier']
+    write_dir = os.path.join(base_directory, iden)
 
-        iden = spec['identifier']
-        show = Show(iden)
-        write_dir = os.path.join(base_directory, iden)
+    if os.path.exists(os.path.join(write_dir, 'transcript.txt')):
+        return False
+
+    if profile is True:
+        profile = ShowProfile(iden)
+    show_profile = profile or None
+
+    tmp_dir = None
+    try:
+        show = Show(iden, throttle=throttle, profile=show_profile)
 
-        if not os.path.exists(os.path.join(write_dir, 'transcript.txt')):
+        tmp_dir = tempfile.mkdtemp(prefix='.' + iden + '.',
+                                   dir=base_directory)
 
-            if os.path.isdir(write_dir):
-                os.removedirs(write_dir)
+        ts = show.get_transcript(verbose=verbose, profile=show_profile)
 
-            os.mkdir(write_dir)
+        # get_transcript only warns when captions can't be fetched
+        if not show.srt.strip():
+            raise TranscriptUnavailable(
+                'No captions recovered for ' + iden
+            )
 
-            ts = show.get_transcript(verbose=verbose)
-            ts_file_path = os.path.join(write_dir, 'transcript.txt')
-            open(ts_file_path, 'w').write('\n\n'.join(ts).encode('utf-8'))
+        with stage(show_profile, 'write'):
+            ts_file_path = os.path.join(tmp_dir, 'transcript.txt')
+            _write_utf8(ts_file_path, '\n\n'.join(ts))
 
             md = show.metadata
             md.update(spec)
-            md_file_path = os.path.join(write_dir, 'metadata.json')
-            open(md_file_path, 'w').write(json.dumps(md).encode('utf-8'))
+            md_file_path = os.path.join(tmp_dir, 'metadata.json')
+            _write_utf8(md_file_path, json.dumps(md))
+
+            srt_file_path = os.path.join(tmp_dir, show.srt_fname)
+            _write_utf8(srt_file_path, show.srt)
 
-            srt_file_path = os.path.join(write_dir, show.srt_fname)
-            open(srt_file_path, 'w').write(show.srt.encode('utf-8'))
+        if show_profile is not None:
+            show_profile.finish()
+            show_profile.write(tmp_dir)
+
+        # left behind by an older, non-atomic download
+        if os.path.isdir(write_dir) and not os.path.exists(
+                os.path.join(write_dir, 'transcript.txt')):
+            shutil.rmtree(write_dir, ignore_errors=True)
+
+        try:
+            os.rename(tmp_dir, write_dir)
+        except OSError:
+            # another worker finished the same show first
+            if not os.path.exists(os.path.join(write_dir, 'transcript.txt')):
+                raise
+            return False
+
+    finally:
+        if show_profile is not None:
+            show_profile.finish()
+        if tmp_dir and os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return True
+
+
+def _write_utf8(path, text):
+    # codecs.open takes unicode text on both Python 2 and 3
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def run_worker(queue, base_directory=None, worker_id=None, verbose=True,
+               poll_interval=None):
+    '''
+    Claim shows from ``queue`` and download them until it is empty. Run
+    this in as many processes, on as many hosts sharing ``base_directory``,
+    as you like. Leases are renewed by a background heartbeat while each
+    show downloads, and every request to archive.org draws on the queue's
+    shared request budget. If the lease on a show is lost, e.g. because
+    heartbeats were held up long enough for another worker to claim it, the
+    download is abandoned at its next request and left to the other worker.
+
+    Arguments:
+        queue (WorkQueue): queue populated with ``WorkQueue.put``
+        base_directory (str): directory where downloads should be put
+        worker_id (str): unique name for this worker; generated if None
+        poll_interval (float): if given, keep polling for new work every
+            this many seconds instead of returning when the queue is empty
+
+    Returns:
+        (int) number of shows this worker completed
+    '''
+
+    if not worker_id:
+        worker_id = default_worker_id()
+
+    n_done = 0
+    while True:
+
+        spec = queue.claim(worker_id)
+
+        if spec is None:
+            if poll_interval is None:
+                return n_done
+            time.sleep(poll_interval)
+            continue
+
+        iden = spec['identifier']
+        heartbeat = Heartbeat(queue, iden, worker_id)
+        heartbeat.start()
+
+        try:
+            download_transcript(spec, base_directory=base_directory,
+                                verbose=verbose,
+                                throttle=_lease_throttle(queue, heartbeat))
+
+        except LeaseLost:
+            heartbeat.stop()
+            warnings.warn(
+                'Worker {} lost its lease on {}; leaving it to the worker '
+                'that now holds it'.format(worker_id, iden)
+            )
+
+        except Exception as e:
+            heartbeat.stop()
+            warnings.warn(
+                'Worker {} failed to download {}\n\n{}'.format(
+                    worker_id, iden, e)
+            )
+            queue.fail(iden, worker_id)
+
+        else:
+            heartbeat.stop()
+            if queue.complete(iden, worker_id):
+                n_done += 1
+
+
+def _lease_throttle(queue, heartbeat):
+
+    def throttle():
+        if heartbeat.lost.is_set():
+            raise LeaseLost(heartbeat.identifier)
+        queue.throttle()
+
+    return throttle
 
 
 Runtime = namedtuple('Runtime', ['h', 'm', 's'])
@@ -247,11 +446,18 @@ class Show:
     >>> s = Show(shows.pop()['identifier'])
     >>> tr = s.get_transcript(verbose=False)  # download captions to this object in memory
     >>> open('transcript-out.txt', 'w').write('\n\n'.join(tr).encode('utf-8'))
+
+    Pass ``throttle``, a callable such as ``WorkQueue.throttle``, to have it
+    called before every request this Show makes to archive.org, and
+    ``profile``, a ``ShowProfile``, to profile fetching the metadata.
     '''
-    def __init__(self, identifier):
+    def __init__(self, identifier, throttle=None, profile=None):
+
+        self.throttle = throttle
 
         try:
-            metadata = get_show_metadata(identifier)
+            metadata = get_show_metadata(identifier, throttle=throttle,
+                                         profile=profile)
             self.metadata = metadata
             self.title = metadata['title'].pop()
             self.identifier = identifier
@@ -270,6 +476,7 @@ class Show:
 
         self.srt = ''
         self.srt_fname = ''
+        self.profile = None
         self.transcript = ''
         self.last_start_time = None
         self.last_end_time = None
@@ -289,15 +496,32 @@ class Show:
             self.identifier + '.mp4?t=' + str(start_time) + '/' +\
             str(stop_time) + '&exact=1&ignore=x.mp4'
 
+        if self.throttle:
+            self.throttle()
+
         res = requests.get(url)
 
         with open(download_path, 'wb') as handle:
             handle.write(res.content)
 
-    def get_transcript(self, start_time=0, end_time=None, verbose=True):
+    def get_transcript(self, start_time=0, end_time=None, verbose=True,
+                       profile=False):
         '''
         Fetch the transcript for the specified times
+
+        If ``profile`` is True, record a per-stage breakdown of wall time,
+        CPU time, allocations and hot functions in ``self.profile``, a
+        ``ShowProfile``, and log its summary. Pass a ``ShowProfile`` instead
+        to record into it without finishing or logging it.
         '''
+        own_profile = profile is True
+        if own_profile:
+            profile = ShowProfile(self.identifier)
+        if profile:
+            self.profile = profile
+        else:
+            profile = None
+
         updated_times = (
             self.last_start_time == start_time and
             self.last_end_time == end_time
@@ -320,7 +544,9 @@ class Show:
                     _srt_gen_from_url(
                         self.transcript_download_url,
                         end_time=end_time,
-                        verbose=verbose
+                        verbose=verbose,
+                        throttle=self.throttle,
+                        profile=profile
                     )
                 )
 
@@ -329,14 +555,22 @@ class Show:
                 ).split('?t=')[0].split('/')[-1]
 
                 # XXX not the best, but ok for now. FIXME
-                self.transcript = _make_ts_from_srt(self.srt)
+                with stage(profile, 'transcript_filter'):
+                    self.transcript = _make_ts_from_srt(self.srt)
+
+            except LeaseLost:
+                raise
 
             except Exception as e:
                 warnings.warn(
                     'Failed to recover transcript from URL ' +
-                    self.transcript_download_url + '\n\n' + e.message
+                    self.transcript_download_url + '\n\n' + str(e)
                 )
 
+        if own_profile:
+            profile.finish()
+            profile.log()
+
         return self.transcript
 
     def __repr__(self):
@@ -363,17 +597,23 @@ def timedelta_from_title(title):
     return (et - st).seconds
 
 
-def get_show_metadata(identifier):
+def get_show_metadata(identifier, throttle=None, profile=None):
 
     url = 'https://archive.org/details/' + identifier
 
-    r = requests.get(url, params={'output': 'json'},
-                     headers={'Content-type': 'application/json'})
+    if throttle:
+        with stage(profile, 'throttle'):
+            throttle()
 
-    return r.json()['metadata']
+    with stage(profile, 'metadata'):
+        r = requests.get(url, params={'output': 'json'},
+                         headers={'Content-type': 'application/json'})
 
+        return r.json()['metadata']
 
-def _srt_gen_from_url(base_url, end_time=3660, verbose=True):
+
+def _srt_gen_from_url(base_url, end_time=3660, verbose=True, throttle=None,
+                      profile=None):
 
     dt = 60
     t0 = 0
@@ -390,19 +630,26 @@ def _srt_gen_from_url(base_url, end_time=3660, verbose=True):
             print('fetching captions from ' +
                   base_url + '?t={}/{}'.format(t0, t1))
 
-        if first:
-            first = False
-            res = requests.get(base_url, params={'t': '{}/{}'.format(t0, t1)})
-            res.raise_for_status()
+        if throttle:
+            with stage(profile, 'throttle'):
+                throttle()
+
+        with stage(profile, 'network'):
+            if first:
+                first = False
+                res = requests.get(base_url,
+                                   params={'t': '{}/{}'.format(t0, t1)})
+                res.raise_for_status()
 
-            srt = res.text.replace(u'\ufeff', '')
+                srt = res.text.replace(u'\ufeff', '')
 
-        else:
-            res = requests.get(base_url, params={'t': '{}/{}'.format(t0, t1)})
+            else:
+                res = requests.get(base_url,
+                                   params={'t': '{}/{}'.format(t0, t1)})
 
-            res.raise_for_status()
+                res.raise_for_status()
 
-            srt = res.text
+                srt = res.text
 
         t0 = t1 + 1
         t1 = t1 + dt
@@ -410,21 +657,22 @@ def _srt_gen_from_url(base_url, end_time=3660, verbose=True):
 
         if srt:
 
-            cc = CaptionConverter()
-            cc.read(srt, SRTReader())
-            captions = cc.captions.get_captions(lang='en-US')
+            with stage(profile, 'srt_parse'):
+                cc = CaptionConverter()
+                cc.read(srt, SRTReader())
+                captions = cc.captions.get_captions(lang='en-US')
 
-            if first:
-                last_end = captions[-1].end
+                if first:
+                    last_end = captions[-1].end
 
-            else:
-                for caption in captions:
-                    caption.start += last_end
-                    caption.end += last_end
+                else:
+                    for caption in captions:
+                        caption.start += last_end
+                        caption.end += last_end
 
-                last_end = captions[-1].end
+                    last_end = captions[-1].end
 
-            srt = cc.write(SRTWriter())
+                srt = cc.write(SRTWriter())
 
             yield srt.replace('\n\n', ' \n\n')
 
@@ -0,0 +1,368 @@
+'''
+profiling.py: Per-stage wall time, CPU time, allocation, and function-level
+profiles of the show download pipeline, for working out why a show is slow.
+
+Example:
+
+>>> from iatv import Show
+>>> s = Show('FOXNEWSW_20160701_000000_The_OReilly_Factor')
+>>> tr = s.get_transcript(profile=True)
+>>> print(s.profile.summary())
+>>> s.profile.write_collapsed('oreilly.folded')  # for flamegraph.pl/speedscope
+
+The stages recorded are ``throttle`` (waiting on a shared request budget
+such as ``WorkQueue.throttle``), ``metadata`` and ``network`` (requests to
+archive.org), ``srt_parse`` (pycaption parsing and re-writing of each
+caption chunk), ``transcript_filter`` (normalizing, filtering and converting
+the SRT to a transcript) and ``write`` (encoding and writing files).
+
+Profiling needs tracemalloc, so Python 3.4 or later. This module imports on
+any interpreter, so that ``import iatv`` keeps working on Python 2, but
+creating a ``ShowProfile`` there raises RuntimeError. Before Python 3.9,
+which added ``tracemalloc.reset_peak``, a stage's ``peak_bytes`` is only a
+lower bound when an earlier stage reached a higher peak.
+'''
+import cProfile
+import logging
+import os
+import pstats
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# deepest call stack written by ShowProfile.write_collapsed
+MAX_STACK_DEPTH = 64
+
+
+def _tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        raise RuntimeError(
+            'iatv profiling needs Python 3.4 or later for tracemalloc'
+        )
+    return tracemalloc
+
+
+class StageStats(object):
+    '''
+    Totals for one stage of the pipeline, accumulated over every time the
+    stage was entered.
+    '''
+    __slots__ = ('name', 'calls', 'wall', 'cpu', 'alloc_bytes', 'peak_bytes')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.alloc_bytes = 0
+        self.peak_bytes = 0
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.alloc_bytes += other.alloc_bytes
+        self.peak_bytes = max(self.peak_bytes, other.peak_bytes)
+
+
+def _func_label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        # builtins, e.g. "<method 'read' of '_ssl._SSLSocket' objects>"
+        return name
+    return '{}:{}({})'.format(filename, lineno, name)
+
+
+class ShowProfile(object):
+    '''
+    Profile of one show, or of a whole corpus once several have been
+    combined with ``merge``. Record into it by wrapping each stage of work
+    in ``with profile.stage(name):``. Stages must not be nested.
+
+    For each stage, ``alloc_bytes`` is the traced memory the stage left
+    allocated and ``peak_bytes`` the most it used above what was allocated
+    when it started, both read cheaply from ``tracemalloc.get_traced_memory``.
+    ``finish`` takes a single tracemalloc snapshot and keeps, in
+    ``allocations``, the number and size of memory blocks still held by each
+    of the source lines holding the most memory.
+
+    Arguments:
+        name (str): label for the profile, usually the show identifier
+    '''
+    def __init__(self, name):
+
+        _tracemalloc()
+
+        self.name = name
+        self.stages = OrderedDict()
+        # {stage: {function label: [ncalls, tottime, cumtime]}}
+        self.functions = OrderedDict()
+        # {stage: {(caller label, callee label): cumtime of those calls}}
+        self.edges = OrderedDict()
+        # {"file:line": [blocks, bytes]}
+        self.allocations = OrderedDict()
+
+        self._profilers = {}
+        self._started_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name):
+
+        tracemalloc = _tracemalloc()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+        stats = self.stages.setdefault(name, StageStats(name))
+        profiler = self._profilers.setdefault(name, cProfile.Profile())
+
+        can_reset_peak = hasattr(tracemalloc, 'reset_peak')
+        if can_reset_peak:
+            tracemalloc.reset_peak()
+        current0, peak0 = tracemalloc.get_traced_memory()
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+
+        profiler.enable()
+        try:
+            yield stats
+        finally:
+            profiler.disable()
+
+            stats.wall += time.perf_counter() - wall0
+            stats.cpu += time.process_time() - cpu0
+            stats.calls += 1
+
+            current, peak = tracemalloc.get_traced_memory()
+            stats.alloc_bytes += max(current - current0, 0)
+
+            # Without reset_peak the peak is the highest since tracing began,
+            # which only tells us about this stage if the stage raised it.
+            if not can_reset_peak and peak <= peak0:
+                peak = current
+            stats.peak_bytes = max(stats.peak_bytes, peak - current0)
+
+    def finish(self, n_allocations=10):
+        '''
+        Collect function-level statistics from the stage profilers, record
+        the ``n_allocations`` source lines holding the most traced memory,
+        and stop tracemalloc if this profile started it. Safe to call more
+        than once.
+        '''
+        if self._profilers:
+            tracemalloc = _tracemalloc()
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                for stat in snapshot.statistics('lineno')[:n_allocations]:
+                    frame = stat.traceback[0]
+                    totals = self.allocations.setdefault(
+                        '{}:{}'.format(frame.filename, frame.lineno), [0, 0])
+                    totals[0] += stat.count
+                    totals[1] += stat.size
+
+        for name, profiler in self._profilers.items():
+
+            functions = self.functions.setdefault(name, {})
+            edges = self.edges.setdefault(name, {})
+            for func, (cc, nc, tt, ct, callers) in \
+                    pstats.Stats(profiler).stats.items():
+
+                label = _func_label(func)
+                totals = functions.setdefault(label, [0, 0.0, 0.0])
+                totals[0] += nc
+                totals[1] += tt
+                totals[2] += ct
+
+                for caller, caller_stats in callers.items():
+                    edge = (_func_label(caller), label)
+                    edges[edge] = edges.get(edge, 0.0) + caller_stats[3]
+
+        self._profilers = {}
+
+        if self._started_tracemalloc:
+            _tracemalloc().stop()
+            self._started_tracemalloc = False
+
+    def merge(self, other):
+        '''
+        Add the stages and functions of ``other``, a finished ShowProfile,
+        to this one, e.g. to build a corpus-level profile.
+        '''
+        for name, stats in other.stages.items():
+            self.stages.setdefault(name, StageStats(name)).merge(stats)
+
+        for name, functions in other.functions.items():
+            mine = self.functions.setdefault(name, {})
+            for label, (nc, tt, ct) in functions.items():
+                totals = mine.setdefault(label, [0, 0.0, 0.0])
+                totals[0] += nc
+                totals[1] += tt
+                totals[2] += ct
+
+        for name, edges in other.edges.items():
+            mine = self.edges.setdefault(name, {})
+            for edge, ct in edges.items():
+                mine[edge] = mine.get(edge, 0.0) + ct
+
+        for location, (count, size) in other.allocations.items():
+            totals = self.allocations.setdefault(location, [0, 0])
+            totals[0] += count
+            totals[1] += size
+
+    def hot_paths(self, limit=20):
+        '''
+        Returns:
+            (list(tuple)) (stage, function, ncalls, tottime, cumtime) for the
+            ``limit`` functions with the most time spent in their own code
+        '''
+        rows = [(stage, label, nc, tt, ct)
+                for stage, functions in self.functions.items()
+                for label, (nc, tt, ct) in functions.items()]
+
+        rows.sort(key=lambda r: r[3], reverse=True)
+
+        return rows[:limit]
+
+    def summary(self, limit=20):
+        '''
+        Returns:
+            (str) table of per-stage totals followed by the ranked hot paths
+        '''
+        total_wall = sum(s.wall for s in self.stages.values()) or 1.0
+
+        lines = [
+            'Profile of {}'.format(self.name),
+            '{:<18} {:>6} {:>10} {:>10} {:>6} {:>14} {:>14}'.format(
+                'stage', 'calls', 'wall (s)', 'cpu (s)', 'wall%',
+                'alloc bytes', 'peak bytes'),
+        ]
+        for s in self.stages.values():
+            lines.append(
+                '{:<18} {:>6} {:>10.3f} {:>10.3f} {:>6.1f} {:>14} '
+                '{:>14}'.format(
+                    s.name, s.calls, s.wall, s.cpu,
+                    100.0 * s.wall / total_wall,
+                    s.alloc_bytes, s.peak_bytes)
+            )
+
+        lines.append('')
+        lines.append('{:<18} {:>10} {:>10} {:>10}  {}'.format(
+            'stage', 'tottime', 'cumtime', 'ncalls', 'function'))
+        for stage, label, nc, tt, ct in self.hot_paths(limit):
+            lines.append('{:<18} {:>10.3f} {:>10.3f} {:>10}  {}'.format(
+                stage, tt, ct, nc, label))
+
+        if self.allocations:
+            lines.append('')
+            lines.append('{:>12} {:>14}  {}'.format(
+                'blocks held', 'bytes held', 'allocated at'))
+            for location, (count, size) in sorted(
+                    self.allocations.items(), key=lambda item: item[1][1],
+                    reverse=True)[:limit]:
+                lines.append('{:>12} {:>14}  {}'.format(
+                    count, size, location))
+
+        return '\n'.join(lines)
+
+    def collapsed_stacks(self):
+        '''
+        Rebuild call stacks from the caller-to-callee edges cProfile records.
+        cProfile does not keep whole stacks, so a function called from
+        several places has its time shared between them in proportion to
+        the cumulative time of each call edge, as gprof2dot does; stacks
+        through such functions are estimates. Recursive calls are folded
+        into the first frame of the function, and stacks are cut off at
+        ``MAX_STACK_DEPTH`` frames.
+
+        Returns:
+            (list(tuple)) (frames, microseconds) for each stack, where
+            frames runs from ``name`` and the stage down to the function
+            whose own time is counted
+        '''
+        stacks = []
+
+        for stage, functions in self.functions.items():
+
+            children = {}
+            called = set()
+            for (caller, callee), ct in self.edges.get(stage, {}).items():
+                if caller in functions and callee in functions and \
+                        caller != callee:
+                    children.setdefault(caller, []).append((callee, ct))
+                    called.add(callee)
+
+            visited = set()
+
+            def visit(label, frames, share):
+                visited.add(label)
+
+                us = int(round(functions[label][1] * share * 1e6))
+                if us:
+                    stacks.append((frames, us))
+
+                if len(frames) - 2 >= MAX_STACK_DEPTH:
+                    return
+
+                for child, edge_ct in children.get(label, ()):
+                    child_ct = functions[child][2]
+                    if child in frames[2:] or child_ct <= 0:
+                        continue
+
+                    child_share = share * min(edge_ct / child_ct, 1.0)
+                    if child_ct * child_share * 1e6 >= 1:
+                        visit(child, frames + [child], child_share)
+
+            for label in functions:
+                if label not in called:
+                    visit(label, [self.name, stage, label], 1.0)
+
+            # functions only reachable through a cycle of calls
+            for label in functions:
+                if label not in visited:
+                    visit(label, [self.name, stage, label], 1.0)
+
+        return stacks
+
+    def write_collapsed(self, path):
+        '''
+        Write ``collapsed_stacks`` in the collapsed-stack format read by
+        flamegraph.pl, speedscope and inferno: one
+        ``name;stage;caller;...;function microseconds`` line per stack,
+        weighted by the time spent in the last function's own code.
+        '''
+        with open(path, 'w') as f:
+            for frames, us in self.collapsed_stacks():
+                f.write('{} {}\n'.format(
+                    ';'.join(frame.replace(';', ':') for frame in frames), us))
+
+    def write(self, directory, prefix='profile'):
+        '''
+        Write ``{prefix}.folded`` (collapsed stacks) and ``{prefix}.txt``
+        (summary) to ``directory``.
+        '''
+        self.write_collapsed(os.path.join(directory, prefix + '.folded'))
+        with open(os.path.join(directory, prefix + '.txt'), 'w') as f:
+            f.write(self.summary() + '\n')
+
+    def log(self, level=logging.INFO):
+        logger.log(level, self.summary())
+
+
+@contextmanager
+def _null_stage():
+    yield None
+
+
+def stage(profile, name):
+    '''
+    ``profile.stage(name)`` if ``profile`` is a ShowProfile, otherwise a
+    context that does nothing, so code can be profiled optionally.
+    '''
+    if profile is None:
+        return _null_stage()
+    return profile.stage(name)
@@ -0,0 +1,390 @@
+'''
+workqueue.py: A SQLite-backed work queue so several harvesting processes,
+possibly on several hosts sharing one filesystem, can cooperatively download
+shows into the same base directory.
+
+Example, run the same script on as many workers as you like:
+
+>>> from iatv import search_items, WorkQueue, run_worker
+>>> q = WorkQueue('July2016-queue.sqlite', max_requests_per_second=5)
+>>> items = search_items('I', channel='FOXNEWSW', time='201607', rows=1000)
+>>> q.put([item for item in items if 'commercial' not in item])
+>>> run_worker(q, base_directory='July2016', verbose=False)
+
+Note that SQLite locking depends on the shared filesystem honoring POSIX
+advisory locks (NFSv4 and most cluster filesystems do; some SMB mounts do
+not), and that the shared rate budget and lease expiry rely on worker
+clocks being roughly in sync.
+'''
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import warnings
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    identifier TEXT PRIMARY KEY,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_expires);
+CREATE TABLE IF NOT EXISTS rate_budget (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    rate REAL,
+    burst REAL NOT NULL
+);
+'''
+
+
+_BUDGET_NAME = 'archive.org'
+
+
+class LeaseLost(Exception):
+    '''
+    Raised to abandon work on a show whose lease this worker no longer holds.
+    '''
+
+
+def _clamp_burst(rate, burst):
+    # The bucket must be able to hold a whole request or throttle never
+    # finds enough tokens.
+    return max(1.0, float(burst or rate or 1))
+
+
+def default_worker_id():
+    '''
+    Returns:
+        (str) identifier unique to this host and process
+    '''
+    return '{}:{}:{}'.format(
+        socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+    )
+
+
+class WorkQueue:
+    '''
+    Queue of show specifications (as returned by ``search_items``) stored in
+    a SQLite database. Workers claim shows atomically and hold them under a
+    lease that must be renewed with ``heartbeat``; shows whose lease expires,
+    e.g. because their worker crashed, are handed out again by ``claim``.
+
+    The queue also holds a global token-bucket request budget shared by all
+    workers; call ``throttle`` before every request to archive.org. The rate
+    and burst are stored in the database by the first queue to set them, and
+    every other worker uses the stored values whatever it was constructed
+    with; change them for everyone with ``set_rate``.
+
+    Arguments:
+        path (str): path to the SQLite database, created if missing
+        lease_seconds (float): how long a claim is valid without a heartbeat
+        max_attempts (int): claims after which a show is marked failed
+        max_requests_per_second (float): shared request rate across all
+            workers; None to use the rate stored in the database, if any
+        burst (float): maximum number of requests that may be saved up;
+            at least 1, and defaults to max(1, max_requests_per_second)
+    '''
+    def __init__(self, path, lease_seconds=300, max_attempts=3,
+                 max_requests_per_second=None, burst=None):
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+        def _init_rate(conn):
+            row = conn.execute(
+                'SELECT rate, burst FROM rate_budget WHERE name = ?',
+                (_BUDGET_NAME,)
+            ).fetchone()
+
+            if row is None or row[0] is None:
+                if row is None or max_requests_per_second:
+                    self._store_rate(conn, max_requests_per_second, burst)
+                return
+
+            if max_requests_per_second and (
+                    row[0] != max_requests_per_second or
+                    (burst and row[1] != _clamp_burst(
+                        max_requests_per_second, burst))):
+                warnings.warn(
+                    'Ignoring max_requests_per_second={}, burst={}; using '
+                    'rate {} and burst {} stored in {}. Use set_rate to '
+                    'change them.'.format(
+                        max_requests_per_second, burst, row[0], row[1], path)
+                )
+
+        self._transaction(_init_rate)
+
+    @property
+    def max_requests_per_second(self):
+        return self._read_rate()[0]
+
+    @property
+    def burst(self):
+        return self._read_rate()[1]
+
+    def _read_rate(self):
+        conn = self._connect()
+        try:
+            return conn.execute(
+                'SELECT rate, burst FROM rate_budget WHERE name = ?',
+                (_BUDGET_NAME,)
+            ).fetchone()
+        finally:
+            conn.close()
+
+    def _store_rate(self, conn, max_requests_per_second, burst):
+        burst = _clamp_burst(max_requests_per_second, burst)
+        conn.execute(
+            'INSERT OR REPLACE INTO rate_budget '
+            '(name, tokens, updated, rate, burst) VALUES (?, ?, ?, ?, ?)',
+            (_BUDGET_NAME, burst, time.time(), max_requests_per_second, burst)
+        )
+
+    def set_rate(self, max_requests_per_second, burst=None):
+        '''
+        Change the shared request budget for every worker using this queue.
+
+        Arguments:
+            max_requests_per_second (float): new rate; None for no limit
+            burst (float): maximum number of requests that may be saved up
+        '''
+        self._transaction(lambda conn: self._store_rate(
+            conn, max_requests_per_second, burst))
+
+    def _connect(self):
+        # A fresh connection per operation keeps the queue safe to use from
+        # heartbeat threads and forked workers alike.
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return conn
+
+    def _transaction(self, func):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                ret = func(conn)
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return ret
+        finally:
+            conn.close()
+
+    def put(self, show_specs):
+        '''
+        Add show specifications to the queue. Shows already in the queue,
+        whatever their status, are left alone.
+
+        Arguments:
+            show_specs (list(dict)): specifications from ``search_items``
+
+        Returns:
+            (int) number of newly-queued shows
+        '''
+        rows = [(spec['identifier'], json.dumps(spec), PENDING)
+                for spec in show_specs]
+
+        def _put(conn):
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO items (identifier, spec, status) '
+                'VALUES (?, ?, ?)', rows
+            )
+            return conn.total_changes - before
+
+        return self._transaction(_put)
+
+    def claim(self, worker_id):
+        '''
+        Atomically lease the next pending show, or a show whose lease
+        has expired.
+
+        Arguments:
+            worker_id (str): unique name of the claiming worker
+
+        Returns:
+            (dict) show specification, or None if nothing is claimable
+        '''
+        def _claim(conn):
+            now = time.time()
+
+            # Expired leases that have used up their attempts are given up on.
+            conn.execute(
+                'UPDATE items SET status = ?, worker = NULL '
+                'WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+                (FAILED, LEASED, now, self.max_attempts)
+            )
+
+            row = conn.execute(
+                'SELECT identifier, spec FROM items '
+                'WHERE status = ? OR (status = ? AND lease_expires < ?) '
+                'ORDER BY attempts, identifier LIMIT 1',
+                (PENDING, LEASED, now)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute(
+                'UPDATE items SET status = ?, worker = ?, lease_expires = ?, '
+                'attempts = attempts + 1 WHERE identifier = ?',
+                (LEASED, worker_id, now + self.lease_seconds, row[0])
+            )
+
+            return json.loads(row[1])
+
+        return self._transaction(_claim)
+
+    def heartbeat(self, identifier, worker_id):
+        '''
+        Extend the lease on a claimed show.
+
+        Returns:
+            (bool) False if the lease was lost, e.g. it expired and another
+            worker has since claimed the show
+        '''
+        return self._update_own(
+            identifier, worker_id,
+            'lease_expires = ?', (time.time() + self.lease_seconds,)
+        )
+
+    def complete(self, identifier, worker_id):
+        '''
+        Mark a claimed show as done.
+
+        Returns:
+            (bool) False if the lease had already been lost
+        '''
+        return self._update_own(
+            identifier, worker_id,
+            'status = ?, worker = NULL, lease_expires = NULL', (DONE,)
+        )
+
+    def fail(self, identifier, worker_id):
+        '''
+        Give up a claimed show. It is re-queued unless it has used up
+        ``max_attempts``, in which case it is marked failed.
+
+        Returns:
+            (bool) False if the lease had already been lost
+        '''
+        return self._update_own(
+            identifier, worker_id,
+            'status = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+            'worker = NULL, lease_expires = NULL',
+            (self.max_attempts, FAILED, PENDING)
+        )
+
+    def _update_own(self, identifier, worker_id, assignments, values):
+
+        def _update(conn):
+            cur = conn.execute(
+                'UPDATE items SET ' + assignments +
+                ' WHERE identifier = ? AND worker = ? AND status = ?',
+                tuple(values) + (identifier, worker_id, LEASED)
+            )
+            return cur.rowcount == 1
+
+        return self._transaction(_update)
+
+    def counts(self):
+        '''
+        Returns:
+            (dict) number of shows in each status
+        '''
+        conn = self._connect()
+        try:
+            return dict(conn.execute(
+                'SELECT status, COUNT(*) FROM items GROUP BY status'
+            ).fetchall())
+        finally:
+            conn.close()
+
+    def throttle(self):
+        '''
+        Block until the shared request budget allows one more request to
+        archive.org. Does nothing if the queue has no rate set.
+        '''
+        def _take(conn):
+            now = time.time()
+            tokens, updated, rate, burst = conn.execute(
+                'SELECT tokens, updated, rate, burst FROM rate_budget '
+                'WHERE name = ?', (_BUDGET_NAME,)
+            ).fetchone()
+
+            if not rate:
+                return 0.0
+
+            tokens = min(burst, tokens + max(now - updated, 0.0) * rate)
+
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / rate
+
+            conn.execute(
+                'UPDATE rate_budget SET tokens = ?, updated = ? '
+                'WHERE name = ?', (tokens, now, _BUDGET_NAME)
+            )
+            return wait
+
+        wait = self._transaction(_take)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._transaction(_take)
+
+
+class Heartbeat(threading.Thread):
+    '''
+    Background thread renewing the lease on one claimed show every
+    ``interval`` seconds until stopped. ``lost`` is set if renewal fails;
+    ``run_worker`` then raises ``LeaseLost`` at the show's next request.
+    '''
+    def __init__(self, queue, identifier, worker_id, interval=None):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.queue = queue
+        self.identifier = identifier
+        self.worker_id = worker_id
+        self.interval = interval or queue.lease_seconds / 3.0
+
+        self.lost = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.identifier, self.worker_id):
+                    self.lost.set()
+                    return
+            except sqlite3.OperationalError:
+                # Database busy for longer than the timeout; try next beat.
+                pass
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,37 @@
+'''
+Shared archive.org mocks for the tests
+'''
+import responses
+
+from iatv.iatv import DOWNLOAD_BASE_URL
+
+SRT = '''1
+00:00:00,000 --> 00:00:10,312
+This is an example SRT file,
+which, while extremely short,
+is still a valid SRT file.
+'''
+
+
+def add_show(rsps, identifier, metadata_body=None, captions=True):
+    '''
+    Mock archive.org for a one-minute show; the runtime is popped by Show, so
+    get_transcript works the length out from the title
+    '''
+    url = 'https://archive.org/details/' + identifier + '?output=json'
+
+    if metadata_body is None:
+        rsps.add(responses.GET, url,
+                 json={'metadata': {'title': ['test show 8:00pm-8:01pm'],
+                                    'runtime': ['00:01:00']}},
+                 content_type='application/json',
+                 match_querystring=True)
+    else:
+        rsps.add(responses.GET, url, body=metadata_body,
+                 match_querystring=True)
+
+    if captions:
+        rsps.add(responses.GET,
+                 DOWNLOAD_BASE_URL + identifier + '/' + identifier +
+                 '.cc5.srt?t=0/60',
+                 body=SRT, match_querystring=True)
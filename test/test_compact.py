@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from iatv.compact import (
+    CompactCaptions, CompactShow, TextStore, iter_show_batches, parse_srt
+)
+
+
+def _write_show(directory, identifier):
+    show_dir = os.path.join(directory, identifier)
+    os.mkdir(show_dir)
+    shutil.copy('test/data/expected.srt',
+                os.path.join(show_dir, identifier + '.cc5.srt'))
+    with open(os.path.join(show_dir, 'metadata.json'), 'w') as f:
+        json.dump({'title': ['test show'], 'channel': ['FOXNEWSW']}, f)
+
+
+def test_parse_srt():
+    '''
+    Timings should come out in milliseconds, with caption lines joined
+    '''
+    captions = list(parse_srt(open('test/data/expected.srt').read()))
+
+    assert len(captions) == 4
+    assert captions[0][:2] == (0, 10312)
+    assert captions[0][2] == (
+        'This is an example SRT file, which, while extremely short, '
+        'is still a valid SRT file.'
+    )
+
+
+def test_spill_round_trip():
+    '''
+    Spilled caption text should read back the same from disk
+    '''
+    captions = CompactCaptions.from_srt(open('test/data/expected.srt').read())
+    before = list(captions)
+
+    with TextStore() as store:
+        captions.spill(store)
+        assert captions.spilled
+        assert list(captions) == before
+
+
+def test_iter_show_batches_respects_ceiling():
+    '''
+    Each batch should stay under the memory ceiling, and no show be lost
+    '''
+    directory = tempfile.mkdtemp()
+    for i in range(5):
+        _write_show(directory, 'Test_Show_{}'.format(i))
+
+    one = CompactShow.from_directory(os.path.join(directory, 'Test_Show_0'))
+    assert one.title == 'test show'
+
+    ceiling = 2 * one.nbytes()
+    batches = list(iter_show_batches(directory, max_memory=ceiling))
+
+    assert sum(len(b) for b in batches) == 5
+    assert all(sum(s.nbytes() for s in b) <= ceiling for b in batches)
+
+
+def test_shared_intern_table():
+    '''
+    Repeated unicode strings across shows should be stored once
+    '''
+    directory = tempfile.mkdtemp()
+    for i in range(2):
+        _write_show(directory, 'Test_Show_{}'.format(i))
+
+    srt = u'1\n00:00:00,000 --> 00:00:01,000\n\u00bfQu\u00e9 pasa?\n'
+    for i in range(2):
+        show_dir = os.path.join(directory, 'Test_Show_{}'.format(i))
+        with io.open(os.path.join(show_dir, 'Test_Show_{}.cc5.srt'.format(i)),
+                     'w', encoding='utf-8') as f:
+            f.write(srt)
+
+    strings = {}
+    a, b = [CompactShow.from_directory(os.path.join(directory, d), strings)
+            for d in ('Test_Show_0', 'Test_Show_1')]
+
+    assert a.captions.text(0) == u'\u00bfQu\u00e9 pasa?'
+    assert a.captions.text(0) is b.captions.text(0)
+    assert a.metadata['channel'][0] is b.metadata['channel'][0]
@@ -0,0 +1,209 @@
+import os
+import re
+import responses
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+from iatv.iatv import Show, download_all_transcripts, DOWNLOAD_BASE_URL
+from iatv.profiling import ShowProfile, stage
+
+from . import add_show, SRT
+
+
+def _busy():
+    return [str(i) for i in range(20000)]
+
+
+def test_stages_and_outputs():
+    '''
+    Stages should accumulate time and allocations, and the collapsed-stack
+    output should attribute functions to their stage
+    '''
+    profile = ShowProfile('Test_Show')
+
+    for _ in range(2):
+        with profile.stage('srt_parse'):
+            kept = _busy()
+    with stage(profile, 'transcript_filter'):
+        _busy()
+    with stage(None, 'network'):
+        pass
+
+    profile.finish()
+    assert not tracemalloc.is_tracing()
+
+    assert list(profile.stages) == ['srt_parse', 'transcript_filter']
+    assert profile.stages['srt_parse'].calls == 2
+    assert profile.stages['srt_parse'].alloc_bytes >= \
+        sum(len(x) for x in kept)
+    assert profile.stages['transcript_filter'].peak_bytes > 0
+    assert profile.allocations
+
+    assert any('_busy' in label for _, label, _, _, _ in profile.hot_paths())
+
+    directory = tempfile.mkdtemp()
+    profile.write(directory)
+
+    folded = open(os.path.join(directory, 'profile.folded')).read()
+    assert 'Test_Show;srt_parse;' in folded
+    assert all(line.rsplit(' ', 1)[1].isdigit()
+               for line in folded.splitlines())
+
+    assert 'transcript_filter' in \
+        open(os.path.join(directory, 'profile.txt')).read()
+
+
+def _inner():
+    return sorted(str(i) for i in range(20000))
+
+
+def _outer():
+    return _inner()
+
+
+def test_collapsed_stacks_follow_calls():
+    '''
+    Collapsed stacks should nest callees under their callers, and share out
+    all of the functions' own time
+    '''
+    profile = ShowProfile('Test_Show')
+    with profile.stage('transcript_filter'):
+        _outer()
+    profile.finish()
+
+    stacks = profile.collapsed_stacks()
+    labels = [[frame.split('(')[-1] for frame in frames]
+              for frames, _ in stacks]
+
+    assert ['Test_Show', 'transcript_filter', '_outer)', '_inner)'] in \
+        [frames[:4] for frames in labels]
+
+    own = sum(tt for _, tt, _ in profile.functions['transcript_filter']
+              .values())
+    assert abs(sum(us for _, us in stacks) / 1e6 - own) < 0.01
+
+
+def test_merge():
+    '''
+    Merging show profiles should sum their stages into a corpus profile
+    '''
+    corpus = ShowProfile('corpus')
+
+    for iden in ('a', 'b'):
+        profile = ShowProfile(iden)
+        with profile.stage('write'):
+            _busy()
+        profile.finish()
+        corpus.merge(profile)
+
+    assert corpus.stages['write'].calls == 2
+
+
+def test_get_transcript_profile():
+    '''
+    Profiling a transcript should record each pipeline stage, with waiting
+    on the request budget counted separately from the requests themselves
+    '''
+    throttled = []
+
+    with responses.RequestsMock() as rsps:
+        add_show(rsps, 'Test_Show')
+
+        s = Show('Test_Show', throttle=lambda: throttled.append(1))
+        transcript = s.get_transcript(verbose=False, profile=True)
+
+    assert 'example SRT file' in transcript[-1]
+    assert not tracemalloc.is_tracing()
+
+    assert list(s.profile.stages) == \
+        ['throttle', 'network', 'srt_parse', 'transcript_filter']
+    assert s.profile.stages['throttle'].calls == 1
+    assert s.profile.stages['network'].calls == 1
+    assert s.profile.functions['srt_parse']
+
+
+def test_download_all_transcripts_profile():
+    '''
+    Profiled downloads should save a profile with each show and return one
+    for the whole corpus
+    '''
+    base = tempfile.mkdtemp()
+    specs = [{'identifier': 'Test_Show_0'}, {'identifier': 'Test_Show_1'}]
+
+    with responses.RequestsMock() as rsps:
+        for spec in specs:
+            add_show(rsps, spec['identifier'])
+
+        corpus = download_all_transcripts(specs, base_directory=base,
+                                          verbose=False, profile=True)
+
+    assert not tracemalloc.is_tracing()
+    assert sorted(corpus.stages) == sorted(
+        ['metadata', 'network', 'srt_parse', 'transcript_filter', 'write'])
+    assert corpus.stages['metadata'].calls == 2
+    assert corpus.stages['write'].calls == 2
+
+    for spec in specs:
+        show_dir = os.path.join(base, spec['identifier'])
+        assert os.path.exists(os.path.join(show_dir, 'transcript.txt'))
+
+        folded = open(os.path.join(show_dir, 'profile.folded')).read()
+        assert spec['identifier'] + ';write;' in folded
+        summary = open(os.path.join(show_dir, 'profile.txt')).read()
+        assert 'srt_parse' in summary
+
+
+def _time_long_show(profile):
+    '''
+    Time get_transcript on a mocked hour-long show, fetched in 60 chunks
+    '''
+    with responses.RequestsMock() as rsps, warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+
+        rsps.add(responses.GET,
+                 'https://archive.org/details/Long_Show?output=json',
+                 json={'metadata': {'title': ['long show 8:00pm-9:00pm'],
+                                    'runtime': ['01:00:00']}},
+                 match_querystring=True)
+        rsps.add(responses.GET,
+                 re.compile(DOWNLOAD_BASE_URL + 'Long_Show/.*'), body=SRT)
+
+        s = Show('Long_Show')
+
+        t0 = time.time()
+        s.get_transcript(verbose=False, profile=profile)
+        return time.time() - t0, s
+
+
+def test_profile_overhead():
+    '''
+    Profiling should slow a show down by a bounded factor, and nearly all
+    of the profiled time should be accounted for by its stages
+    '''
+    plain = min(_time_long_show(False)[0] for _ in range(2))
+    profiled, s = _time_long_show(True)
+
+    assert s.profile.stages['network'].calls == 60
+
+    stage_total = sum(stats.wall for stats in s.profile.stages.values())
+    assert profiled < 1.5 * stage_total + 0.1
+    assert profiled < 30 * plain + 0.5
+
+
+def test_profile_without_reset_peak(monkeypatch):
+    '''
+    Before Python 3.9 there is no tracemalloc.reset_peak; profiling should
+    still work, with peaks as lower bounds
+    '''
+    monkeypatch.delattr(tracemalloc, 'reset_peak')
+
+    profile = ShowProfile('Test_Show')
+    with profile.stage('srt_parse'):
+        kept = _busy()
+    profile.finish()
+
+    assert profile.stages['srt_parse'].peak_bytes >= \
+        profile.stages['srt_parse'].alloc_bytes > 0
+    assert kept
@@ -0,0 +1,280 @@
+import os
+import responses
+import tempfile
+import time
+import warnings
+
+from iatv.iatv import download_transcript, run_worker, DOWNLOAD_BASE_URL
+from iatv.workqueue import WorkQueue, DONE, FAILED
+
+from . import add_show
+
+
+def _make_queue(**kwargs):
+    path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite')
+    return WorkQueue(path, **kwargs)
+
+
+def test_claim_is_exclusive():
+    '''
+    Each show should be handed to only one worker, and only queued once
+    '''
+    q = _make_queue()
+
+    assert q.put([{'identifier': 'a'}, {'identifier': 'b'}]) == 2
+    assert q.put([{'identifier': 'a'}]) == 0
+
+    s1 = q.claim('w1')
+    s2 = q.claim('w2')
+
+    assert {s1['identifier'], s2['identifier']} == {'a', 'b'}
+    assert q.claim('w3') is None
+
+    assert q.complete(s1['identifier'], 'w1')
+    assert not q.complete(s2['identifier'], 'w1')
+    assert q.counts()[DONE] == 1
+
+
+def test_expired_lease_is_requeued():
+    '''
+    A show whose worker stops heartbeating should go to another worker,
+    and the original worker should learn it has lost the lease
+    '''
+    q = _make_queue(lease_seconds=0.05, max_attempts=2)
+    q.put([{'identifier': 'a'}])
+
+    assert q.claim('crashed')['identifier'] == 'a'
+    assert q.claim('w2') is None
+
+    time.sleep(0.1)
+
+    assert q.claim('w2')['identifier'] == 'a'
+    assert not q.heartbeat('a', 'crashed')
+    assert q.heartbeat('a', 'w2')
+
+    # second attempt used up, so failing does not re-queue
+    assert q.fail('a', 'w2')
+    assert q.claim('w3') is None
+    assert q.counts()[FAILED] == 1
+
+
+def test_throttle_shares_budget():
+    '''
+    Workers sharing a database should share one request budget
+    '''
+    q1 = _make_queue(max_requests_per_second=20, burst=1)
+    q2 = WorkQueue(q1.path, max_requests_per_second=20, burst=1)
+
+    t0 = time.time()
+    for _ in range(3):
+        q1.throttle()
+        q2.throttle()
+
+    # 6 requests with 1 saved up at 20/s takes at least 5/20 s
+    assert time.time() - t0 >= 0.2
+
+
+def test_throttle_rate_below_one():
+    '''
+    A rate under one request per second should still let requests through
+    '''
+    q = _make_queue(max_requests_per_second=0.5, burst=0.5)
+    assert q.burst == 1.0
+
+    t0 = time.time()
+    q.throttle()
+    assert time.time() - t0 < 1.0
+
+
+def test_rate_stored_in_database():
+    '''
+    Workers opening an existing queue should use its stored rate, not their
+    own arguments, until it is changed with set_rate
+    '''
+    q1 = _make_queue(max_requests_per_second=20, burst=1)
+
+    q2 = WorkQueue(q1.path)
+    assert q2.max_requests_per_second == 20
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        q3 = WorkQueue(q1.path, max_requests_per_second=1000)
+    assert len(w) == 1
+    assert q3.max_requests_per_second == 20
+
+    q3.set_rate(None)
+    assert q1.max_requests_per_second is None
+
+    t0 = time.time()
+    for _ in range(10):
+        q1.throttle()
+    assert time.time() - t0 < 0.2
+
+
+def _leftover_temp_dirs(base_directory):
+    return [d for d in os.listdir(base_directory) if d.startswith('.')]
+
+
+def test_download_transcript_renames_into_place():
+    '''
+    A download should appear complete in one step and leave no temp dirs
+    '''
+    base = tempfile.mkdtemp()
+
+    with responses.RequestsMock() as rsps:
+        add_show(rsps, 'Test_Show')
+        assert download_transcript({'identifier': 'Test_Show'},
+                                   base_directory=base, verbose=False)
+
+    write_dir = os.path.join(base, 'Test_Show')
+    assert sorted(os.listdir(write_dir)) == \
+        ['Test_Show.cc5.srt', 'metadata.json', 'transcript.txt']
+    assert 'example SRT file' in \
+        open(os.path.join(write_dir, 'transcript.txt')).read()
+    assert _leftover_temp_dirs(base) == []
+
+    # already downloaded, so no requests are made
+    with responses.RequestsMock():
+        assert not download_transcript({'identifier': 'Test_Show'},
+                                       base_directory=base, verbose=False)
+
+
+def test_download_transcript_replaces_half_written_dir():
+    '''
+    A show directory without a transcript, e.g. from a crashed worker,
+    should be replaced
+    '''
+    base = tempfile.mkdtemp()
+    write_dir = os.path.join(base, 'Test_Show')
+    os.mkdir(write_dir)
+    open(os.path.join(write_dir, 'stale.txt'), 'w').write('stale')
+
+    with responses.RequestsMock() as rsps:
+        add_show(rsps, 'Test_Show')
+        assert download_transcript({'identifier': 'Test_Show'},
+                                   base_directory=base, verbose=False)
+
+    assert not os.path.exists(os.path.join(write_dir, 'stale.txt'))
+    assert os.path.exists(os.path.join(write_dir, 'transcript.txt'))
+    assert _leftover_temp_dirs(base) == []
+
+
+def test_download_transcript_other_worker_finished_first():
+    '''
+    If another worker finishes the same show mid-download, its files
+    should be kept and ours discarded
+    '''
+    base = tempfile.mkdtemp()
+    write_dir = os.path.join(base, 'Test_Show')
+    calls = []
+
+    def throttle():
+        calls.append(1)
+        # the other worker finishes while we fetch captions
+        if len(calls) == 2:
+            os.mkdir(write_dir)
+            open(os.path.join(write_dir, 'transcript.txt'), 'w')\
+                .write('theirs')
+
+    with responses.RequestsMock() as rsps:
+        add_show(rsps, 'Test_Show')
+        assert not download_transcript({'identifier': 'Test_Show'},
+                                       base_directory=base, verbose=False,
+                                       throttle=throttle)
+
+    assert os.listdir(write_dir) == ['transcript.txt']
+    assert open(os.path.join(write_dir, 'transcript.txt')).read() == 'theirs'
+    assert _leftover_temp_dirs(base) == []
+
+
+def test_run_worker_completes_and_fails():
+    '''
+    Shows that download should be completed, and shows that raise failed
+    '''
+    base = tempfile.mkdtemp()
+    q = _make_queue(max_attempts=1)
+    q.put([{'identifier': 'Good_Show'}, {'identifier': 'Bad_Show'}])
+
+    with responses.RequestsMock() as rsps, \
+            warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+
+        add_show(rsps, 'Good_Show')
+        add_show(rsps, 'Bad_Show', metadata_body='not json',
+                 captions=False)
+
+        assert run_worker(q, base_directory=base, worker_id='w1',
+                          verbose=False) == 1
+
+    assert q.counts() == {DONE: 1, FAILED: 1}
+    assert any('Bad_Show' in str(warning.message) for warning in w)
+    assert os.listdir(base) == ['Good_Show']
+
+
+def test_run_worker_fails_show_without_captions():
+    '''
+    A show whose captions can't be fetched should be failed, with the
+    HTTP error reported, and nothing written for it
+    '''
+    base = tempfile.mkdtemp()
+    q = _make_queue(max_attempts=1)
+    q.put([{'identifier': 'Test_Show'}])
+
+    with responses.RequestsMock() as rsps, \
+            warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+
+        add_show(rsps, 'Test_Show', captions=False)
+        rsps.add(responses.GET,
+                 DOWNLOAD_BASE_URL + 'Test_Show/Test_Show.cc5.srt?t=0/60',
+                 status=503, match_querystring=True)
+
+        assert run_worker(q, base_directory=base, worker_id='w1',
+                          verbose=False) == 0
+
+    messages = [str(warning.message) for warning in w]
+    assert any('503' in m for m in messages)
+    assert any('No captions recovered for Test_Show' in m for m in messages)
+    assert not any('attribute' in m for m in messages)
+
+    assert q.counts() == {FAILED: 1}
+    assert os.listdir(base) == []
+
+
+class _LostLeaseQueue(WorkQueue):
+    '''
+    Queue whose heartbeats always fail, and whose first request is slow
+    enough for the heartbeat thread to notice
+    '''
+    def heartbeat(self, identifier, worker_id):
+        return False
+
+    def throttle(self):
+        time.sleep(0.1)
+
+
+def test_run_worker_abandons_lost_lease():
+    '''
+    A worker should stop downloading a show once its lease is lost, and
+    neither complete nor write it
+    '''
+    base = tempfile.mkdtemp()
+    q = _LostLeaseQueue(os.path.join(tempfile.mkdtemp(), 'queue.sqlite'),
+                        lease_seconds=0.03, max_attempts=1)
+    q.put([{'identifier': 'Test_Show'}])
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps, \
+            warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+
+        add_show(rsps, 'Test_Show')
+
+        assert run_worker(q, base_directory=base, worker_id='w1',
+                          verbose=False) == 0
+
+        # metadata was fetched, captions were not
+        assert len(rsps.calls) == 1
+
+    assert any('lost its lease' in str(warning.message) for warning in w)
+    assert DONE not in q.counts()
+    assert os.listdir(base) == []